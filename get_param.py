@@ -1,23 +1,105 @@
-from pathlib import Path
+import hashlib
+import os
+import pickle
 from functools import lru_cache
+from pathlib import Path
 from typing import Any, Union, Optional
 import yaml
 
+# Prefer the libyaml C parser; fall back to the pure-Python one when PyYAML
+# was built without libyaml (install libyaml-dev, or
+# `pip install pyyaml --no-binary pyyaml`, to get the C bindings).
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 # Default to config.yaml located next to this script
 DEFAULT_CONFIG_PATH = Path(__file__).with_name("config.yaml")
 
+# path -> ((path, st_mtime_ns, st_size, st_ino), parsed config)
+_CACHE: dict = {}
+# Bumped whenever a config is (re)parsed so memoized lookups in _resolve go stale
+_VERSION = 0
+_MISSING = object()
+
 
-@lru_cache(maxsize=1)
 def _load_config(path: Union[str, Path] = DEFAULT_CONFIG_PATH) -> dict:
     """
     Load YAML config from the given path and cache the result.
+    The in-process cache is keyed by the file's stat, so edits are picked up
+    automatically; across runs a pickled sidecar keyed by content hash is used.
     """
+    global _VERSION
     p = Path(path)
-    if not p.exists():
+    try:
+        st = p.stat()
+    except FileNotFoundError:
+        # Forget the removed file so memoized lookups in _resolve don't outlive it
+        if _CACHE.pop(str(p), None) is not None:
+            _VERSION += 1
         return {}
-    with p.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f)
-    return data or {}
+    key = (str(p), st.st_mtime_ns, st.st_size, st.st_ino)
+    hit = _CACHE.get(str(p))
+    if hit and hit[0] == key:
+        return hit[1]
+    raw = p.read_bytes()
+    # Reuse the pickled sidecar for identical content and skip YAML parsing
+    digest = hashlib.blake2b(raw, digest_size=8).hexdigest()
+    cache_path = p.with_name(f"{p.name}.{digest}.pkl")
+    data = None
+    if cache_path.exists():
+        try:
+            # Tighten sidecars left world-readable by older versions
+            if cache_path.stat().st_mode & 0o077:
+                os.chmod(cache_path, 0o600)
+            data = pickle.loads(cache_path.read_bytes())
+        except Exception:
+            data = None
+    if data is None:
+        data = yaml.load(raw, Loader=_YamlLoader) or {}
+        _write_pickle_cache(p, cache_path, data)
+    _CACHE[str(p)] = (key, data)
+    _VERSION += 1
+    return data
+
+
+def _write_pickle_cache(p: Path, cache_path: Path, data: dict) -> None:
+    """
+    Store the parsed config next to the YAML file (mode 0600) and drop stale sidecars.
+    The config is developer-controlled, so unpickling it later is safe.
+    Failures (e.g. read-only directory) are ignored; the YAML stays authoritative.
+    """
+    try:
+        for stale in p.parent.glob(f"{p.name}.*.pkl"):
+            if stale != cache_path:
+                stale.unlink(missing_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        # The sidecar holds secrets such as refreshtoken, so keep it owner-only
+        tmp_path.unlink(missing_ok=True)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pickle.dumps(data, protocol=5))
+        tmp_path.replace(cache_path)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=128)
+def _resolve(version: int, name: str, path: str) -> Any:
+    """
+    Walk the dotted key through the config. Memoized per config version,
+    so repeated lookups skip the split and the dict walk.
+    """
+    current: Any = _load_config(path)
+
+    for part in name.split("."):
+        if isinstance(current, dict) and part in current:
+            current = current[part]
+        else:
+            return _MISSING
+
+    return current
 
 
 def get_param(
@@ -30,21 +112,18 @@ def get_param(
     Supports nested keys using dot notation (e.g., "database.host").
     Returns `default` if the key is not found or the file is missing.
     """
-    cfg = _load_config(path)
-    current: Any = cfg
-
-    for part in name.split("."):
-        if isinstance(current, dict) and part in current:
-            current = current[part]
-        else:
-            return default
-
-    return current
+    # Stat check first: bumps _VERSION if the file changed since the last parse
+    _load_config(path)
+    value = _resolve(_VERSION, name, str(path))
+    return default if value is _MISSING else value
 
 
 def reload_config(path: Union[str, Path] = DEFAULT_CONFIG_PATH) -> None:
     """
     Clear cache and reload config for subsequent calls.
     """
-    _load_config.cache_clear()
-    _load_config(path)
\ No newline at end of file
+    global _VERSION
+    _CACHE.clear()
+    _VERSION += 1
+    _resolve.cache_clear()
+    _load_config(path)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+# idTokens are valid for 24 hours; reuse them for at most 23 to leave a margin
+MAX_AGE_SECONDS = 23 * 3600
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "jquants" / "idtoken.json"
+
+
+def _fingerprint(refreshtoken: str) -> str:
+    """
+    Short digest of the refresh token, so a cached idToken is only reused
+    for the account it was issued to (the refresh token itself is not stored).
+    """
+    return hashlib.blake2b(refreshtoken.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def load_id_token(
+    refreshtoken: str,
+    path: Union[str, Path] = DEFAULT_CACHE_PATH,
+) -> Optional[str]:
+    """
+    Return the cached idToken for `refreshtoken` if it is younger than
+    MAX_AGE_SECONDS. Returns None if there is no usable cache entry.
+    """
+    try:
+        entry = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("refresh") != _fingerprint(refreshtoken):
+        return None
+    ts = entry.get("ts")
+    if isinstance(ts, bool) or not isinstance(ts, (int, float)) or time.time() - ts >= MAX_AGE_SECONDS:
+        return None
+    return entry.get("token") or None
+
+
+def save_id_token(
+    refreshtoken: str,
+    token: str,
+    path: Union[str, Path] = DEFAULT_CACHE_PATH,
+) -> None:
+    """
+    Store the idToken with its issuance time, readable only by the current user.
+    Failures are ignored; the next run simply refreshes again.
+    """
+    p = Path(path)
+    entry = {"ts": time.time(), "refresh": _fingerprint(refreshtoken), "token": token}
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(p, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+    except OSError:
+        pass
+
+
+def clear_id_token(path: Union[str, Path] = DEFAULT_CACHE_PATH) -> None:
+    """
+    Drop the cached idToken, e.g. after the API rejected it.
+    """
+    try:
+        Path(path).unlink(missing_ok=True)
+    except OSError:
+        pass
+
+
+def is_unauthorized(exc: BaseException) -> bool:
+    """
+    True if `exc` is an HTTP error (requests or httpx) for a 401 response.
+    """
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) == 401
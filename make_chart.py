@@ -1,15 +1,49 @@
 import json
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util import make_headers
+# orjson があればレスポンスの JSON 解析に使う（標準の json より高速）
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 from IPython.display import display
+import numpy as np
 import pandas as pd
 import re
+from operator import itemgetter
 from pathlib import Path
-import yaml
+from get_param import get_param
+from id_token import clear_id_token, is_unauthorized, load_id_token, save_id_token
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 API_URL = "https://api.jquants.com"
 
+# 同一ホストへの大量リクエストで TCP/TLS 接続を使い回すための共有セッション
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+    ),
+)
+# 応答の圧縮を明示的に要求する（br/zstd は対応パッケージが入っている場合のみ urllib3 が含める）。
+# requests のバージョンによらず、urllib3 が展開できる方式だけを送るようにしておく
+_SESSION.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+# ティッカーごとのチャート作成を並列化するワーカー数（pool_maxsize 以下に保つ）
+MAX_WORKERS = 16
+# 描画用の Figure は全ティッカーで使い回すため、描画と保存はこのロックで直列化する
+_PLOT_LOCK = threading.Lock()
+_CHART = None
+_ENCODING_LOGGED = threading.Event()
+
 def debug(msg: str):
     """シンプルなデバッグ出力（タイムスタンプ付き）"""
     try:
@@ -18,37 +52,90 @@ def debug(msg: str):
     except Exception:
         print(f"[DEBUG] {msg}")
 
-def make_chart(headers, code: str, company_name: str, output_dir: Path, start_date: str | None = None, end_date: str | None = None) -> pd.DataFrame:
+def _get_chart():
+    """
+    チャート描画用の (Figure, 価格 Axes, 出来高 Axes) を返す。
+    pyplot を介さず Agg の Figure を初回だけ生成し、以降は再利用する。
+    """
+    global _CHART
+    if _CHART is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure(figsize=(10, 6))
+        FigureCanvasAgg(fig)
+        ax_price = fig.add_subplot(111)
+        ax_vol = ax_price.twinx()
+        # tight_layout の代わりに余白は一度だけ固定する（下端は autofmt_xdate が調整）
+        fig.subplots_adjust(left=0.08, right=0.9, top=0.94)
+        _CHART = (fig, ax_price, ax_vol)
+    return _CHART
+
+def _clear_chart(ax_price, ax_vol) -> None:
+    """前回の描画内容を消去する。cla() で初期化される twinx の設定は付け直す。"""
+    ax_price.cla()
+    ax_vol.cla()
+    ax_vol.yaxis.tick_right()
+    ax_vol.yaxis.set_label_position("right")
+    ax_vol.yaxis.set_offset_position("right")
+    ax_vol.xaxis.set_visible(False)
+    ax_vol.patch.set_visible(False)
+
+def _float_column(quotes: list[dict], key: str) -> np.ndarray:
+    """日足レコードの列を float64 配列として取り出す（欠損は NaN）"""
+    return np.fromiter(
+        (np.nan if q.get(key) is None else q[key] for q in quotes),
+        dtype=np.float64,
+        count=len(quotes),
+    )
+
+def _moving_average(c: np.ndarray, n: int) -> np.ndarray:
+    """
+    累積和による単純移動平均。rolling(n).mean() と同様に、
+    窓内に欠損がある位置と先頭 n-1 件は NaN になる。
+    """
+    ma = np.full_like(c, np.nan)
+    if c.size < n:
+        return ma
+    valid = ~np.isnan(c)
+    cs = np.concatenate(([0.0], np.cumsum(np.where(valid, c, 0.0))))
+    cnt = np.concatenate(([0], np.cumsum(valid)))
+    window_sum = cs[n:] - cs[:-n]
+    ma[n-1:] = np.where(cnt[n:] - cnt[:-n] == n, window_sum / n, np.nan)
+    return ma
+
+def make_chart(headers, code: str, company_name: str, output_dir: Path, from_date: str, to_date: str) -> pd.DataFrame:
     """
     価格チャート用の時系列データ（日足）を取得して整形して返す。
 
     Args:
         headers: API 認証ヘッダ（Bearer トークン）
         code (str): 銘柄コード
-        start_date (str | None): 開始日（YYYY-MM-DD）。未指定ならAPIデフォルト。
-        end_date (str | None): 終了日（YYYY-MM-DD）。未指定ならAPIデフォルト。
+        company_name (str): 会社名（画像ファイル名に使用）
+        output_dir (Path): チャート画像の保存先
+        from_date (str): 開始日（YYYY-MM-DD）。呼び出し側でループの外で一度だけ計算する。
+        to_date (str): 終了日（YYYY-MM-DD）
     """
-    debug(f"make_chart start: code={code}, company_name={company_name}, start_date={start_date}, end_date={end_date}")
-    delay_days = 12*7  # J-Quants APIのFreeプランのため12週間遅延
-    lookback_days = 180
-
-    # 取得期間を決定
-    if start_date or end_date:
-        from_date = start_date or (pd.Timestamp.today() - pd.Timedelta(days=lookback_days + delay_days)).strftime("%Y-%m-%d")
-        to_date = end_date or (pd.Timestamp.today().normalize() - pd.Timedelta(days=delay_days)).strftime("%Y-%m-%d")
-    else:
-        to_date = (pd.Timestamp.today().normalize() - pd.Timedelta(days=delay_days)).strftime("%Y-%m-%d")
-        from_date = (pd.Timestamp.today() - pd.Timedelta(days=lookback_days + delay_days)).strftime("%Y-%m-%d")
-    debug(f"fetch range: from={from_date}, to={to_date}")
+    debug(f"make_chart start: code={code}, company_name={company_name}, from_date={from_date}, to_date={to_date}")
 
     # API 呼び出し
     url = f"{API_URL}/v1/prices/daily_quotes"
     params = {"code": code, "from": from_date, "to": to_date}
     try:
-        res = requests.get(url, headers=headers, params=params, timeout=30)
+        res = _SESSION.get(url, headers=headers, params=params, timeout=30)
+    except Exception:
+        return pd.DataFrame()
+    if res.status_code == 401:
+        # idToken が拒否された場合は "No data" 扱いにせず、呼び出し側で取り直せるよう例外にする
+        res.raise_for_status()
+    try:
         if res.status_code != 200:
             return pd.DataFrame()
-        data = res.json()
+        if not _ENCODING_LOGGED.is_set():
+            # 圧縮のネゴシエーション結果は最初の応答で一度だけ確認する
+            _ENCODING_LOGGED.set()
+            debug(f"response content-encoding: {res.headers.get('Content-Encoding')}")
+        data = _json_loads(res.content)
     except Exception:
         return pd.DataFrame()
 
@@ -56,60 +143,69 @@ def make_chart(headers, code: str, company_name: str, output_dir: Path, start_da
     if not quotes:
         return pd.DataFrame()
 
-    # 整形
-    df = pd.DataFrame(quotes)
     # 必須カラムの存在チェック
     required = ["Date", "Open", "High", "Low", "Close", "Volume"]
-    missing = [c for c in required if c not in df.columns]
+    missing = [c for c in required if c not in quotes[0]]
     if missing:
         return pd.DataFrame()
 
-    df["Date"] = pd.to_datetime(df["Date"])
-    df = df.sort_values("Date").reset_index(drop=True)
-
-    # 列名整形と選択
-    df = df.rename(columns={
-        "Date": "date",
-        "Open": "open",
-        "High": "high",
-        "Low": "low",
-        "Close": "close",
-        "Volume": "volume"
-    })[["date", "open", "high", "low", "close", "volume"]]
+    # 整形（使う列だけを型を決めて直接構築し、dtype 推論を避ける）
+    quotes.sort(key=itemgetter("Date"))  # ISO 形式の日付は文字列順で並ぶ
+    df = pd.DataFrame({
+        "date": pd.to_datetime([q["Date"] for q in quotes], format="%Y-%m-%d"),
+        "open": _float_column(quotes, "Open"),
+        "high": _float_column(quotes, "High"),
+        "low": _float_column(quotes, "Low"),
+        "close": _float_column(quotes, "Close"),
+        "volume": _float_column(quotes, "Volume"),
+    }, columns=["date", "open", "high", "low", "close", "volume"])
 
     # 簡単な指標（任意）
-    df["ma20"] = df["close"].rolling(20).mean()
-    df["ma60"] = df["close"].rolling(60).mean()
+    close = df["close"].to_numpy()
+    df["ma20"] = _moving_average(close, 20)
+    df["ma60"] = _moving_average(close, 60)
 
     # プロットして画像を保存
-    try:
-        import matplotlib.pyplot as plt
-
-        fig, ax_price = plt.subplots(figsize=(10, 6))
-        ax_price.plot(df["date"], df["close"], label="Close", color="tab:blue", linewidth=1.5)
-        ax_price.plot(df["date"], df["ma20"], label="MA20", color="tab:orange", linewidth=1.2)
-        ax_price.plot(df["date"], df["ma60"], label="MA60", color="tab:green", linewidth=1.2)
-        ax_price.set_title(f"{code} Price Chart")
-        ax_price.set_xlabel("Date")
-        ax_price.set_ylabel("Price")
-        ax_price.grid(True, alpha=0.3)
-        ax_price.legend(loc="upper left")
+    with _PLOT_LOCK:
+        try:
+            fig, ax_price, ax_vol = _get_chart()
+            _clear_chart(ax_price, ax_vol)
+            ax_price.plot(df["date"], df["close"], label="Close", color="tab:blue", linewidth=1.5)
+            ax_price.plot(df["date"], df["ma20"], label="MA20", color="tab:orange", linewidth=1.2)
+            ax_price.plot(df["date"], df["ma60"], label="MA60", color="tab:green", linewidth=1.2)
+            ax_price.set_title(f"{code} Price Chart")
+            ax_price.set_xlabel("Date")
+            ax_price.set_ylabel("Price")
+            ax_price.grid(True, alpha=0.3)
+            ax_price.legend(loc="upper left")
 
-        ax_vol = ax_price.twinx()
-        ax_vol.bar(df["date"], df["volume"], label="Volume", color="lightgray", alpha=0.6, width=2)
-        ax_vol.set_ylabel("Volume")
-        ax_vol.legend(loc="upper right")
-
-        out_img = output_dir / f"{code}_{company_name}.png"
-        fig.autofmt_xdate()
-        plt.tight_layout()
-        fig.savefig(out_img, dpi=150)
-        plt.close(fig)
-    except Exception:
-        pass
+            ax_vol.bar(df["date"], df["volume"], label="Volume", color="lightgray", alpha=0.6, width=2)
+            ax_vol.set_ylabel("Volume")
+            ax_vol.legend(loc="upper right")
+
+            out_img = output_dir / f"{code}_{company_name}.png"
+            fig.autofmt_xdate()
+            fig.savefig(out_img, dpi=150)
+        except Exception:
+            pass
     return df
 
 
+def _refresh_id_token(refreshtoken: str) -> str:
+    """auth_refresh で idToken を取得してキャッシュに保存する。失敗した場合は終了する。"""
+    res = _SESSION.post(f"{API_URL}/v1/token/auth_refresh?refreshtoken={refreshtoken}", timeout=30)
+    if res.status_code == 200:
+        id_token = res.json().get('idToken')
+        save_id_token(refreshtoken, id_token)
+        display("idTokenの取得に成功しました。")
+        debug("idToken fetched successfully.")
+        return id_token
+    msg = res.json().get("message", f"HTTP {res.status_code}")
+    display(msg)
+    print("Failed to fetch idToken.")
+    sys.exit(1)
+
+
 def main():
     # config.yaml から refreshtoken を取得
     cfg_path = Path(__file__).with_name("config.yaml")
@@ -117,33 +213,24 @@ def main():
         print(f"config.yaml not found at: {cfg_path}")
         sys.exit(1)
     try:
-        with cfg_path.open("r", encoding="utf-8") as f:
-            cfg = yaml.safe_load(f) or {}
+        refreshtoken = get_param("refreshtoken", path=cfg_path)
     except Exception as e:
         print(f"Failed to read config.yaml: {e}")
         sys.exit(1)
 
-    # キーの揺れに対応
-    refreshtoken = cfg.get("refreshtoken")
-
     if not refreshtoken:
         print("Refresh token not found in config.yaml or environment.")
         sys.exit(1)
-    # idToken取得
-    res = requests.post(f"{API_URL}/v1/token/auth_refresh?refreshtoken={refreshtoken}", timeout=30)
-    if res.status_code == 200:
-        id_token = res.json().get('idToken')
-        headers = {'Authorization': f'Bearer {id_token}'}
-        display("idTokenの取得に成功しました。")
-        debug("idToken fetched successfully.")
+    # idToken取得（前回取得した idToken が有効期間内ならそれを使い、auth_refresh を省く）
+    id_token = load_id_token(refreshtoken)
+    cached = id_token is not None
+    if cached:
+        debug("Using cached idToken.")
     else:
-        msg = res.json().get("message", f"HTTP {res.status_code}")
-        display(msg)
-        print("Failed to fetch idToken.")
-        sys.exit(1)
+        id_token = _refresh_id_token(refreshtoken)
 
     # cfg から lookback_days を取得し、既定の取得期間を差し替える
-    lb = int(cfg.get("lookback_days", 180))
+    lb = int(get_param("lookback_days", 180, path=cfg_path))
     delay_days = 12 * 7
     start_date = (pd.Timestamp.today() - pd.Timedelta(days=lb + delay_days)).strftime("%Y-%m-%d")
     end_date = (pd.Timestamp.today().normalize() - pd.Timedelta(days=delay_days)).strftime("%Y-%m-%d")
@@ -175,20 +262,44 @@ def main():
     output_dir = Path(__file__).with_name("charts")
     output_dir.mkdir(exist_ok=True)
 
-    # ティッカーごとにチャート作成
-    results = {}
-    for code, company_name in company_names.items():
+    # ティッカーごとにチャート作成（取得は並列、描画は _PLOT_LOCK で直列）
+    def process(item):
+        code, company_name = item
         try:
-            df = make_chart(headers, code, company_name, start_date, end_date,output_dir)
+            df = make_chart(headers, code, company_name, output_dir, start_date, end_date)
             if not df.empty:
-                results[code] = df
                 print(f"Processed: {code} {company_name}")
+                return code, df
             else:
                 print(f"No data: {code} {company_name}")
         except Exception as e:
+            if is_unauthorized(e):
+                raise
             debug(f"Processing failed for {code} {company_name}: {e}")
             print(f"Failed: {code} {company_name} - {e}")
+        return code, None
 
+    for attempt in range(2):
+        headers = {'Authorization': f'Bearer {id_token}'}
+        results = {}
+        ex = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        try:
+            for code, df in ex.map(process, company_names.items()):
+                if df is not None:
+                    results[code] = df
+            break
+        except Exception as e:
+            if not is_unauthorized(e):
+                raise
+            if not cached or attempt:
+                print(f"idToken was rejected: {e}")
+                sys.exit(1)
+            # キャッシュの idToken が拒否された場合は破棄して一度だけ取り直す
+            debug("Cached idToken was rejected; refreshing.")
+            clear_id_token()
+            id_token = _refresh_id_token(refreshtoken)
+        finally:
+            ex.shutdown(cancel_futures=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,15 +1,67 @@
 import json
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util import make_headers
+# numba があれば銘柄ごとの集約カーネルを JIT コンパイルする
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+# httpx があれば日付ごとの取得を asyncio + HTTP/2 で多重化する（h2 が無ければ HTTP/1.1）
+try:
+    import httpx
+except ImportError:
+    httpx = None
+# orjson があればレスポンスの JSON 解析に使う（標準の json より高速）
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 from IPython.display import display
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import yaml
 from get_param import get_param
+from id_token import clear_id_token, is_unauthorized, load_id_token, save_id_token
 import traceback
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import importlib.util
 
 API_URL = "https://api.jquants.com"
+DAILY_QUOTES_PATH = "/v1/prices/daily_quotes"
+
+# 429/5xx の再試行設定（requests 側の Retry と httpx 側の再試行で共有する）
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 同一ホストへの大量リクエストで TCP/TLS 接続を使い回すための共有セッション
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES),
+    ),
+)
+# 応答の圧縮を明示的に要求する（br/zstd は対応パッケージが入っている場合のみ urllib3 が含める）。
+# requests のバージョンによらず、urllib3 が展開できる方式だけを送るようにしておく
+_SESSION.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+# 銘柄ごとの取得を並列化するワーカー数（pool_maxsize 以下に保つ）
+MAX_WORKERS = 16
+# httpx で非同期に取得する場合の同時リクエスト数
+MAX_CONCURRENCY = 32
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_ENCODING_LOGGED = threading.Event()
 
 # 固定パラメータ（引数ではなくコード内に埋め込み）
 # 例: ティッカー、財務諸表の種類、期間を固定値として設定
@@ -31,9 +83,9 @@ def get_financial_data(headers,ticker: str, statement: str, period: str) -> pd.D
 
     endpoint = f"{API_URL}/v1/financials/{statement}"
     params = {"code": ticker, "type": period}
-    resp = requests.get(endpoint, headers=headers, params=params, timeout=30)
+    resp = _SESSION.get(endpoint, headers=headers, params=params, timeout=30)
     resp.raise_for_status()
-    payload = resp.json()
+    payload = _json_loads(resp.content)
     data = payload.get("data") or payload.get("results") or []
     return pd.DataFrame(data)
 
@@ -42,73 +94,267 @@ def get_all_info(headers) -> pd.DataFrame:
     listed/info を使って全企業の情報を取得する。
     """
     endpoint = f"{API_URL}/v1/listed/info"
-    resp = requests.get(endpoint, headers=headers, timeout=30)
+    resp = _SESSION.get(endpoint, headers=headers, timeout=30)
     resp.raise_for_status()
-    payload = resp.json()
+    payload = _json_loads(resp.content)
     return payload.get("info")
 
-def search_drawdown(headers, tickers, lookback_days, threshold, top_n) -> list[str]:
+def get_code_to_name(headers) -> dict[str, str]:
     """
-    指定期間の最大ドローダウンが閾値以下の銘柄を抽出して返す。
+    全企業の銘柄コード→会社名の対応を返す。
 
-    戻り値:
-        List[str]: 条件を満たしたティッカーのリスト（ドローダウンが大きい順に上位のみ）
+    上場銘柄一覧は日次でしか変わらないため、当日分を listed_info_YYYYMMDD.json に保存し、
+    同じ日の再実行では listed/info を呼ばずにそれを読み込む。
     """
-    delay_days = 12*7 # J-Quants APIのFreeプランのため12週間遅延
-    to_date = (pd.Timestamp.today().normalize() - pd.Timedelta(days=delay_days)).strftime("%Y-%m-%d")
-    from_date = (pd.Timestamp.today() - pd.Timedelta(days=lookback_days + delay_days)).strftime("%Y-%m-%d")
+    cache_path = Path(__file__).with_name(f"listed_info_{pd.Timestamp.today():%Y%m%d}.json")
+    if cache_path.exists():
+        try:
+            return json.loads(cache_path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"Failed to read {cache_path.name}: {e}")
 
-    results = []
-    session = requests.Session()
+    infos = get_all_info(headers)
+    code_to_name = {info["Code"]: info.get("CompanyName") or info.get("CompanyNameEnglish") or "" for info in infos}
+    try:
+        for stale in cache_path.parent.glob("listed_info_*.json"):
+            if stale != cache_path:
+                stale.unlink(missing_ok=True)
+        cache_path.write_text(json.dumps(code_to_name, ensure_ascii=False), encoding="utf-8")
+    except OSError as e:
+        print(f"Failed to write {cache_path.name}: {e}")
+    return code_to_name
+
+def _consume_quotes_page(quotes: list[dict], date: str, resp) -> dict | None:
+    """
+    daily_quotes の 1 ページ分（requests / httpx のレスポンス）を quotes に追加し、
+    次ページの params（最終ページなら None）を返す。同期版・非同期版の両方で共有する。
+    """
+    if not _ENCODING_LOGGED.is_set():
+        # 圧縮のネゴシエーション結果は最初の応答で一度だけ確認する
+        _ENCODING_LOGGED.set()
+        print(f"daily_quotes content-encoding: {resp.headers.get('Content-Encoding')}")
+    payload = _json_loads(resp.content)
+    quotes.extend(payload.get("daily_quotes") or payload.get("data") or payload.get("quotes") or [])
+    pagination_key = payload.get("pagination_key")
+    if not pagination_key:
+        return None
+    return {"date": date, "pagination_key": pagination_key}
 
-    for code in tickers:
-        print(f"Processing {code}...")
+def _retry_delay(resp, attempt: int) -> float:
+    """
+    再試行までの待ち時間（秒）。Retry-After があればそれに従い、無ければ指数バックオフ。
+    """
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
         try:
-            resp = session.get(
-                f"{API_URL}/v1/prices/daily_quotes",
-                headers=headers,
-                params={"code": code, "from": from_date, "to": to_date},
-                timeout=30,
-            )
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(retry_after)
+                return max(0.0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return RETRY_BACKOFF_FACTOR * (2 ** attempt)
+
+def _fetch_quotes_by_date(headers, date: str) -> list[dict]:
+    """
+    指定日の全銘柄の日足を取得する（pagination_key によるページングに対応）。
+    リトライしても取得できなかった場合は例外を送出する。
+    """
+    print(f"Processing {date}...")
+    quotes = []
+    params = {"date": date}
+    try:
+        while params:
+            resp = _SESSION.get(f"{API_URL}{DAILY_QUOTES_PATH}", headers=headers, params=params, timeout=30)
             resp.raise_for_status()
-            payload = resp.json()
-            quotes = payload.get("daily_quotes") or payload.get("data") or payload.get("quotes") or []
-            if not quotes:
-                continue
+            params = _consume_quotes_page(quotes, date, resp)
+    except Exception as e:
+        # 1 日でも欠けると全銘柄の最高値・現在値が変わるため、握りつぶさずに呼び出し側へ伝える
+        print(f"  Error processing {date}: {e}")
+        raise
+    return quotes
 
-            df = pd.DataFrame(quotes)
+async def _fetch_quotes_by_date_async(client, date: str) -> list[dict]:
+    """
+    _fetch_quotes_by_date の httpx.AsyncClient 版。
+    httpx のトランスポートは接続エラーしか再試行しないため、429/5xx は Retry-After に従ってここで再試行する。
+    """
+    print(f"Processing {date}...")
+    quotes = []
+    params = {"date": date}
+    try:
+        while params:
+            for attempt in range(RETRY_TOTAL + 1):
+                resp = await client.get(DAILY_QUOTES_PATH, params=params)
+                if resp.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                    break
+                await asyncio.sleep(_retry_delay(resp, attempt))
+            resp.raise_for_status()
+            params = _consume_quotes_page(quotes, date, resp)
+    except Exception as e:
+        # 1 日でも欠けると全銘柄の最高値・現在値が変わるため、握りつぶさずに呼び出し側へ伝える
+        print(f"  Error processing {date}: {e}")
+        raise
+    return quotes
 
-            # 日付でソート
-            date_col = "Date" if "Date" in df.columns else ("date" if "date" in df.columns else None)
-            if date_col:
-                df = df.sort_values(date_col)
+def _extract_prices(quotes: list[dict], code_ids: dict[str, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    1 日分の日足から対象銘柄の (銘柄 ID, 調整後終値) を取り出す。
+    調整後終値が欠損・空文字・数値に変換できない行は除く（pd.to_numeric(errors="coerce").dropna() と同じ扱い）。
+    """
+    ids, prices = [], []
+    for q in quotes:
+        i = code_ids.get(q.get("Code"))
+        price = q.get("AdjustmentClose")
+        if i is None or price in (None, ""):
+            continue
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            continue
+        if price != price:  # NaN
+            continue
+        ids.append(i)
+        prices.append(price)
+    return np.array(ids, dtype=np.int64), np.array(prices, dtype=np.float64)
 
-            s = pd.to_numeric(df["AdjustmentClose"], errors="coerce").dropna()
-            # データ数が少ない場合はスキップ
-            if s.size < 30:
-                continue
+async def _fetch_prices_async(headers, days: list[str], code_ids: dict[str, int]) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    全営業日の日足を 1 つの AsyncClient で並行に取得し、日ごとに _extract_prices した結果を返す。
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limits = httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+    # retries は接続エラーのみ。429/5xx は _fetch_quotes_by_date_async 内で再試行する
+    transport = httpx.AsyncHTTPTransport(http2=_HTTP2, limits=limits, retries=3)
+    async with httpx.AsyncClient(base_url=API_URL, headers=headers, timeout=30, transport=transport) as client:
+        async def fetch(date):
+            async with sem:
+                quotes = await _fetch_quotes_by_date_async(client, date)
+            return _extract_prices(quotes, code_ids)
 
-            # 過去の最高価格と現在価格でドローダウンを算出
-            peak_price = s.max() # 期間内の過去最高値
-            current_price = s.iloc[-1]
+        tasks = [asyncio.ensure_future(fetch(date)) for date in days]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # 1 日でも失敗したら残りの取得を取り消してから例外を伝える
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
 
-            current_dd = current_price / peak_price  # 現在のドローダウン
+def _group_stats_loop(ids: np.ndarray, values: np.ndarray, n_groups: int):
+    """
+    銘柄 ID ごとの件数・最高値・最終値を 1 パスで求める（numba で JIT コンパイルする版）。
+    values は日付の昇順に並んでいること。
+    """
+    counts = np.zeros(n_groups, dtype=np.int64)
+    peaks = np.zeros(n_groups, dtype=np.float64)
+    lasts = np.zeros(n_groups, dtype=np.float64)
+    for i in range(ids.size):
+        g = ids[i]
+        v = values[i]
+        if counts[g] == 0 or v > peaks[g]:
+            peaks[g] = v
+        lasts[g] = v
+        counts[g] += 1
+    return counts, peaks, lasts
 
-            if current_dd <= threshold:
-                print(f"  {code}: Found drawdown: {current_dd:.2%}")
-                results.append({
-                    "Code": code,
-                    "max_drawdown": float(current_dd),
-                })
+def _group_stats_numpy(ids: np.ndarray, values: np.ndarray, n_groups: int):
+    """
+    _group_stats_loop と同じ結果を NumPy の ufunc で求める（numba が無い環境向け）。
+    件数 0 の銘柄の最高値・最終値は呼び出し側で使わないため不定。
+    """
+    counts = np.bincount(ids, minlength=n_groups)
+    peaks = np.full(n_groups, -np.inf)
+    np.maximum.at(peaks, ids, values)
+    last_idx = np.zeros(n_groups, dtype=np.int64)
+    np.maximum.at(last_idx, ids, np.arange(ids.size))
+    lasts = values[last_idx]
+    return counts, peaks, lasts
 
-        except Exception as e:
-            print(f"  Error processing {code}: {e}")
-            traceback.print_exc()
-            continue
+_group_stats = njit(cache=True)(_group_stats_loop) if njit is not None else _group_stats_numpy
+
+def search_drawdown(headers, tickers, lookback_days, threshold, top_n) -> list[str]:
+    """
+    指定期間の最大ドローダウンが閾値以下の銘柄を抽出して返す。
+
+    戻り値:
+        List[str]: 条件を満たしたティッカーのリスト（ドローダウンが大きい順に上位のみ）
+    """
+    tickers = list(tickers)
+    return [tickers[i] for i in search_drawdown_ids(headers, tickers, lookback_days, threshold, top_n)]
+
+def search_drawdown_ids(headers, tickers: list[str], lookback_days, threshold, top_n) -> np.ndarray:
+    """
+    search_drawdown と同じ抽出を行い、条件を満たした銘柄の tickers 内の位置を返す。
 
-    results.sort(key=lambda x: x["max_drawdown"])  # 最も大きいドローダウン順（より負）に並べる
+    銘柄ごとではなく営業日ごとに全銘柄分の日足をまとめて取得するため、
+    リクエスト数は銘柄数ではなく営業日数に比例する。
+
+    いずれかの営業日の取得に失敗した場合は、欠けたデータで選定せずに例外を送出する。
+
+    戻り値:
+        np.ndarray: 条件を満たした銘柄の tickers 内の位置（ドローダウンが大きい順に上位のみ）
+    """
+    delay_days = 12*7 # J-Quants APIのFreeプランのため12週間遅延
+    to_date = (pd.Timestamp.today().normalize() - pd.Timedelta(days=delay_days)).strftime("%Y-%m-%d")
+    from_date = (pd.Timestamp.today() - pd.Timedelta(days=lookback_days + delay_days)).strftime("%Y-%m-%d")
+    days = [d.strftime("%Y-%m-%d") for d in pd.bdate_range(from_date, to_date)]
+
+    # HTTP 待ちが支配的なので並行に取得する。httpx があれば asyncio で、無ければ共有セッションとスレッドで。
+    # 日ごとの DataFrame は作らず、銘柄 ID と価格の配列だけを残して最後にまとめて集約する。
+    code_ids = {code: i for i, code in enumerate(tickers)}
+    try:
+        asyncio.get_running_loop()
+        use_async = False  # Jupyter など既にイベントループが動いている場合は asyncio.run できない
+    except RuntimeError:
+        use_async = httpx is not None
+    if use_async:
+        per_day = asyncio.run(_fetch_prices_async(headers, days, code_ids))
+    else:
+        ex = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        try:
+            per_day = list(ex.map(lambda date: _extract_prices(_fetch_quotes_by_date(headers, date), code_ids), days))
+        finally:
+            # 失敗した場合は残りの取得を待たずに打ち切る
+            ex.shutdown(cancel_futures=True)
+    if not per_day:
+        return np.empty(0, dtype=np.int64)
+    # gather / map はどちらも入力順に結果を返すので、連結後も日付の昇順に並ぶ（ソート不要）
+    ids = np.concatenate([day_ids for day_ids, _ in per_day])
+    prices = np.concatenate([day_prices for _, day_prices in per_day])
+    if not ids.size:
+        return np.empty(0, dtype=np.int64)
 
-    return [r["Code"] for r in results[:top_n]]
+    # 銘柄ごとの件数・期間内最高値・現在値を 1 パスで求める
+    counts, peaks, lasts = _group_stats(ids, prices, len(tickers))
+    # データ数が少ない銘柄と、現在値が最高値×閾値を超える銘柄は比率を計算する前に除外する
+    # （最高値が 0 以下の銘柄は比率が定義できないため除外する）
+    mask = (counts >= 30) & (peaks > 0) & (lasts <= threshold * peaks)
+
+    # 過去の最高価格と現在価格でドローダウンを算出
+    selected = np.flatnonzero(mask)
+    current_dd = lasts[selected] / peaks[selected]
+    order = np.argsort(current_dd, kind="stable")  # 最も大きいドローダウン順（より負）に並べる
+    selected, current_dd = selected[order], current_dd[order]
+    for i, dd in zip(selected, current_dd):
+        print(f"  {tickers[i]}: Found drawdown: {dd:.2%}")
+
+    return selected[:top_n]
+
+def _refresh_id_token(refreshtoken: str) -> str:
+    """
+    auth_refresh で idToken を取得してキャッシュに保存する。失敗した場合は終了する。
+    """
+    res = _SESSION.post(f"{API_URL}/v1/token/auth_refresh?refreshtoken={refreshtoken}")
+    if res.status_code == 200:
+        id_token = res.json()['idToken']
+        save_id_token(refreshtoken, id_token)
+        display("idTokenの取得に成功しました。")
+        return id_token
+    display(res.json()["message"])
+    sys.exit(1)
 
 def main():
     # refreshtokenを取得
@@ -122,32 +368,43 @@ def main():
         sys.exit(1)
     refreshtoken = refreshtoken.strip()
 
-    # idToken取得
-    res = requests.post(f"{API_URL}/v1/token/auth_refresh?refreshtoken={refreshtoken}")
-    if res.status_code == 200:
-        id_token = res.json()['idToken']
-        headers = {'Authorization': 'Bearer {}'.format(id_token)}
-        display("idTokenの取得に成功しました。")
-    else:
-        display(res.json()["message"])
-
-    # 全企業情報のティッカー取得
-    infos = get_all_info(headers)
-    all_tickers = [info["Code"] for info in infos]
+    # idToken取得（前回取得した idToken が有効期間内ならそれを使い、auth_refresh を省く）
+    id_token = load_id_token(refreshtoken)
+    cached = id_token is not None
+    if not cached:
+        id_token = _refresh_id_token(refreshtoken)
 
     lookback_days = get_param("lookback_days")
     threshold = get_param("threshold")
     top_n = get_param("top_n")
 
-    # 検索フィルタ（ロジックで関数を入れ替える）
-    filtered_tickers = search_drawdown(headers, all_tickers, lookback_days=lookback_days, threshold=threshold, top_n=top_n)
+    for attempt in range(2):
+        headers = {'Authorization': 'Bearer {}'.format(id_token)}
+        try:
+            # 全企業情報のティッカーと会社名を取得
+            code_to_name = get_code_to_name(headers)
+            all_tickers = list(code_to_name)
 
-    # ティッカーと会社名のペアをファイルに保存
-    code_to_name = {info["Code"]: info.get("CompanyName") or info.get("CompanyNameEnglish") or "" for info in infos}
-    lines = [f"{code},{code_to_name.get(code, '')}" for code in filtered_tickers]
-    with open("search_result.txt", "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
-    display(f"Wrote {len(filtered_tickers)} ticker-name pairs to search_result.txt")
+            # 検索フィルタ（ロジックで関数を入れ替える）。結果は all_tickers 内の位置で受け取る
+            filtered_ids = search_drawdown_ids(headers, all_tickers, lookback_days=lookback_days, threshold=threshold, top_n=top_n)
+            break
+        except Exception as e:
+            if cached and not attempt and is_unauthorized(e):
+                # キャッシュの idToken が拒否された場合は破棄して一度だけ取り直す
+                print("Cached idToken was rejected; refreshing.")
+                clear_id_token()
+                id_token = _refresh_id_token(refreshtoken)
+                continue
+            # 欠けたデータでの結果で search_result.txt を上書きしない
+            traceback.print_exc()
+            print(f"Search failed; search_result.txt was not updated: {e}")
+            sys.exit(1)
+
+    # ティッカーと会社名のペアをファイルに保存（会社名は all_tickers と同じ並びなので位置で直接引く）
+    names = list(code_to_name.values())
+    lines = [f"{all_tickers[i]},{names[i]}" for i in filtered_ids]
+    Path("search_result.txt").write_bytes("\n".join(lines).encode("utf-8"))
+    display(f"Wrote {len(lines)} ticker-name pairs to search_result.txt")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file